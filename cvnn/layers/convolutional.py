@@ -23,7 +23,7 @@ from tensorflow.python.ops import nn_ops
 from cvnn.layers.core import ComplexLayer
 from cvnn.initializers import ComplexGlorotUniform, Zeros, ComplexInitializer, INIT_TECHNIQUES
 from cvnn import logger
-from cvnn.layers.core import DEFAULT_COMPLEX_TYPE
+from cvnn.layers.core import DEFAULT_COMPLEX_TYPE, SUPPORTED_DTYPES, layer_function
 
 
 class ComplexConv(Layer, ComplexLayer):
@@ -109,6 +109,8 @@ class ComplexConv(Layer, ComplexLayer):
             **kwargs)
         self.rank = rank
         self.my_dtype = tf.dtypes.as_dtype(dtype)
+        if self.my_dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Unsupported dtype {self.my_dtype}, supported dtypes are {SUPPORTED_DTYPES}")
         # I use no default dtype to make sure I don't forget to give it to my ComplexConv layers
         if isinstance(filters, float):
             filters = int(filters)
@@ -138,6 +140,15 @@ class ComplexConv(Layer, ComplexLayer):
         self._channels_first = self.data_format == 'channels_first'
         self._tf_data_format = conv_utils.convert_data_format(
             self.data_format, self.rank + 2)
+        # Convert Keras formats to TF native formats once, they are constant for the whole life of the layer.
+        self._tf_strides = list(self.strides)
+        self._tf_dilations = list(self.dilation_rate)
+        if self._is_causal:
+            self._tf_padding = 'VALID'  # Causal padding handled in `call`.
+        elif isinstance(self.padding, str):
+            self._tf_padding = self.padding.upper()
+        else:
+            self._tf_padding = self.padding
 
         self.init_technique = init_technique.lower()
 
@@ -233,20 +244,12 @@ class ComplexConv(Layer, ComplexLayer):
         self.built = True
 
     def convolution_op(self, inputs, kernel):
-        # Convert Keras formats to TF native formats.
-        if self.padding == 'causal':
-            tf_padding = 'VALID'  # Causal padding handled in `call`.
-        elif isinstance(self.padding, str):
-            tf_padding = self.padding.upper()
-        else:
-            tf_padding = self.padding
-
         return tf.nn.convolution(
             inputs,
             kernel,
-            strides=list(self.strides),
-            padding=tf_padding,
-            dilations=list(self.dilation_rate),
+            strides=self._tf_strides,
+            padding=self._tf_padding,
+            dilations=self._tf_dilations,
             data_format=self._tf_data_format,
             name=self.__class__.__name__)
 
@@ -266,48 +269,59 @@ class ComplexConv(Layer, ComplexLayer):
                          "at the start (tf casts input automatically to real).")
             inputs = tf.cast(inputs, self.my_dtype)
         if self._is_causal:  # Apply causal padding to inputs for Conv1D.
+            # Here and not in complex_convolution_op, where the relaxed input signature can hide the input rank.
             inputs = tf.pad(inputs, self._compute_causal_padding(inputs))
+        batch_rank = inputs.shape.rank - self.rank - 1
+        if batch_rank > 1:  # Fold the extra batch dimensions so complex_convolution_op always gets the same rank.
+            batch_shape = tf.shape(inputs)[:batch_rank]
+            inputs = tf.reshape(inputs, tf.concat([[-1], tf.shape(inputs)[batch_rank:]], axis=0))
+            outputs = self.complex_convolution_op(inputs)
+            return tf.reshape(outputs, tf.concat([batch_shape, tf.shape(outputs)[1:]], axis=0))
+        return self.complex_convolution_op(inputs)
+
+    @layer_function(jit_compile=False)     # XLA regresses some convolutions, graph mode only.
+    def complex_convolution_op(self, inputs):
+        """
+        Computes `activation(conv(inputs, kernel) + bias)` as a single graph.
+        :param inputs: Tensor already casted to the layer dtype (and causally padded if needed).
+        """
         # Convolution
-        inputs_r = tf.math.real(inputs)
-        inputs_i = tf.math.imag(inputs)
         if self.my_dtype.is_complex:
-            kernel_r = self.kernel_r
-            kernel_i = self.kernel_i
+            inputs_r = tf.math.real(inputs)
+            inputs_i = tf.math.imag(inputs)
+            # 4 separate real convolutions, each one bit-exact with the tf.keras convolution of the same operands.
+            real_outputs = self.convolution_op(inputs_r, self.kernel_r) - self.convolution_op(inputs_i, self.kernel_i)
+            imag_outputs = self.convolution_op(inputs_r, self.kernel_i) + self.convolution_op(inputs_i, self.kernel_r)
+            # Bias added to the real parts, right after the real convolutions, where the BiasAdd can be fused.
             if self.use_bias:
-                bias = tf.complex(self.bias_r, self.bias_i)
+                real_outputs = self._add_bias(real_outputs, self.bias_r)
+                imag_outputs = self._add_bias(imag_outputs, self.bias_i)
+            outputs = tf.complex(real_outputs, imag_outputs)    # Already my_dtype, no need to cast
         else:
-            kernel_r = tf.math.real(self.kernel)
-            kernel_i = tf.math.imag(self.kernel)    # TODO: Check they are all zero
+            # Imaginary parts are all zero, only one real convolution is needed.
+            outputs = self.convolution_op(inputs, self.kernel)
             if self.use_bias:
-                bias = self.bias
-        real_outputs = self.convolution_op(inputs_r, kernel_r) - self.convolution_op(inputs_i, kernel_i)
-        imag_outputs = self.convolution_op(inputs_r, kernel_i) + self.convolution_op(inputs_i, kernel_r)
-        outputs = tf.cast(tf.complex(real_outputs, imag_outputs), dtype=self.my_dtype)
-        # Add bias
-        if self.use_bias:
-            output_rank = outputs.shape.rank
-            if self.rank == 1 and self._channels_first:
-                # tf.nn.bias_add does not accept a 1D input tensor.
-                bias = tf.reshape(bias, (1, self.filters, 1))
-                outputs += bias
-            else:
-                # Handle multiple batch dimensions.
-                if output_rank is not None and output_rank > 2 + self.rank:
-
-                    def _apply_fn(o):
-                        # TODO: Will this bias be visible? Horrible
-                        return tf.nn.bias_add(o, bias, data_format=self._tf_data_format)
-
-                    outputs = nn_ops.squeeze_batch_dims(
-                        outputs, _apply_fn, inner_rank=self.rank + 1)
-                else:
-                    outputs = tf.nn.bias_add(
-                        outputs, bias, data_format=self._tf_data_format)
+                outputs = self._add_bias(outputs, self.bias)
         # Activation function
         if self.activation is not None:
             outputs = self.activation(outputs)
         return outputs
 
+    def _add_bias(self, outputs, bias):
+        output_rank = outputs.shape.rank
+        if self.rank == 1 and self._channels_first:
+            # tf.nn.bias_add does not accept a 1D input tensor.
+            bias = tf.reshape(bias, (1, self.filters, 1))
+            return outputs + bias
+        # Handle multiple batch dimensions.
+        if output_rank is not None and output_rank > 2 + self.rank:
+
+            def _apply_fn(o):
+                return tf.nn.bias_add(o, bias, data_format=self._tf_data_format)
+
+            return nn_ops.squeeze_batch_dims(outputs, _apply_fn, inner_rank=self.rank + 1)
+        return tf.nn.bias_add(outputs, bias, data_format=self._tf_data_format)
+
     def _spatial_output_shape(self, spatial_input_shape):
         return [
             conv_utils.conv_output_length(
@@ -508,6 +522,7 @@ class ComplexConv2D(ComplexConv):
             with `filters / groups` filters. The output is the concatenation of all
             the `groups` results along the channel axis. Input channels and `filters`
             must both be divisible by `groups`.
+        :param dtype: Dtype of the input and therefore layer. Either complex64 (default) or float32.
         :param activation: Activation function to use. If you don't specify anything, no activation is applied.
             For complex :code:`dtype`, this must be a :code:`cvnn.activations` module.
         :param use_bias: Boolean, whether the layer uses a bias vector.
@@ -915,61 +930,64 @@ class ComplexConv2DTranspose(ComplexConv2D):
 
         output_shape_tensor = tf.stack(output_shape)
         # Deconvolution part
-        inputs_r = tf.math.real(inputs)
-        inputs_i = tf.math.imag(inputs)
         if self.my_dtype.is_complex:
-            kernel_r = self.kernel_r
-            kernel_i = self.kernel_i
-            if self.use_bias:
-                bias = tf.complex(self.bias_r, self.bias_i)
+            inputs_r = tf.math.real(inputs)
+            inputs_i = tf.math.imag(inputs)
+            real_outputs_ri_rk = backend.conv2d_transpose(
+                inputs_r,
+                self.kernel_r,
+                output_shape_tensor,
+                strides=self.strides,
+                padding=self.padding,
+                data_format=self.data_format,
+                dilation_rate=self.dilation_rate)
+            real_outputs_ii_ik = backend.conv2d_transpose(
+                inputs_i,
+                self.kernel_i,
+                output_shape_tensor,
+                strides=self.strides,
+                padding=self.padding,
+                data_format=self.data_format,
+                dilation_rate=self.dilation_rate)
+            real_outputs_ri_ik = backend.conv2d_transpose(
+                inputs_r,
+                self.kernel_i,
+                output_shape_tensor,
+                strides=self.strides,
+                padding=self.padding,
+                data_format=self.data_format,
+                dilation_rate=self.dilation_rate)
+            real_outputs_ii_rk = backend.conv2d_transpose(
+                inputs_i,
+                self.kernel_r,
+                output_shape_tensor,
+                strides=self.strides,
+                padding=self.padding,
+                data_format=self.data_format,
+                dilation_rate=self.dilation_rate)
+            real_outputs = real_outputs_ri_rk - real_outputs_ii_ik
+            imag_outputs = real_outputs_ii_rk + real_outputs_ri_ik
+            if self.use_bias:   # Bias of the real and imaginary parts added before they are combined.
+                real_outputs = tf.nn.bias_add(real_outputs, self.bias_r, data_format=self._tf_data_format)
+                imag_outputs = tf.nn.bias_add(imag_outputs, self.bias_i, data_format=self._tf_data_format)
+            outputs = tf.complex(real_outputs, imag_outputs)    # Already my_dtype, no need to cast
         else:
-            kernel_r = tf.math.real(self.kernel)
-            kernel_i = tf.math.imag(self.kernel)
+            # Imaginary parts are all zero, only one real transposed convolution is needed.
+            outputs = backend.conv2d_transpose(
+                inputs,
+                self.kernel,
+                output_shape_tensor,
+                strides=self.strides,
+                padding=self.padding,
+                data_format=self.data_format,
+                dilation_rate=self.dilation_rate)
             if self.use_bias:
-                bias = self.bias
-        real_outputs_ri_rk = backend.conv2d_transpose(
-            inputs_r,
-            kernel_r,
-            output_shape_tensor,
-            strides=self.strides,
-            padding=self.padding,
-            data_format=self.data_format,
-            dilation_rate=self.dilation_rate)
-        real_outputs_ii_ik = backend.conv2d_transpose(
-            inputs_i,
-            kernel_i,
-            output_shape_tensor,
-            strides=self.strides,
-            padding=self.padding,
-            data_format=self.data_format,
-            dilation_rate=self.dilation_rate)
-        real_outputs_ri_ik = backend.conv2d_transpose(
-            inputs_r,
-            kernel_i,
-            output_shape_tensor,
-            strides=self.strides,
-            padding=self.padding,
-            data_format=self.data_format,
-            dilation_rate=self.dilation_rate)
-        real_outputs_ii_rk = backend.conv2d_transpose(
-            inputs_i,
-            kernel_r,
-            output_shape_tensor,
-            strides=self.strides,
-            padding=self.padding,
-            data_format=self.data_format,
-            dilation_rate=self.dilation_rate)
-        real_outputs = real_outputs_ri_rk - real_outputs_ii_ik
-        imag_outputs = real_outputs_ii_rk + real_outputs_ri_ik
-        outputs = tf.cast(tf.complex(real_outputs, imag_outputs), dtype=self.my_dtype)
+                outputs = tf.nn.bias_add(outputs, self.bias, data_format=self._tf_data_format)
 
         if not tf.executing_eagerly():
             # Infer the static output shape:
             out_shape = self.compute_output_shape(inputs.shape)
             outputs.set_shape(out_shape)
-        # Apply bias
-        if self.use_bias:
-            outputs = tf.nn.bias_add(outputs, bias, data_format=conv_utils.convert_data_format(self.data_format, ndim=4))
         # Apply activation function
         if self.activation is not None:
             return self.activation(outputs)
@@ -1,6 +1,10 @@
+import os
+import functools
+import numbers
 from abc import ABC, abstractmethod
 import numpy as np
 import tensorflow as tf
+from packaging import version
 from tensorflow.keras.layers import Flatten, Dense, InputLayer, Layer
 from tensorflow.python.keras import backend as K
 from tensorflow.keras import initializers
@@ -26,6 +30,19 @@ t_input = Union[Tensor, tuple, list]
 t_input_shape = Union[TensorShape, List[TensorShape]]
 
 DEFAULT_COMPLEX_TYPE = tf.as_dtype(np.complex64)
+SUPPORTED_DTYPES = (tf.complex64, tf.float32)   # float32 is used by the real-valued equivalent layers
+# XLA compilation of the layers numerical kernels (opt-in). Set the environment variable CVNN_JIT=1 to enable it.
+JIT_COMPILE = os.environ.get("CVNN_JIT", "0") == "1"
+
+
+def layer_function(jit_compile: bool = JIT_COMPILE):
+    """
+    Decorator that wraps a layer method into a `tf.function` that is not re-traced for every new batch size.
+    :param jit_compile: If True (default only if CVNN_JIT=1), the function is compiled with XLA.
+    """
+    if version.parse(tf.__version__) < version.parse("2.9.0"):
+        return functools.partial(tf.function, experimental_compile=jit_compile, experimental_relax_shapes=True)
+    return functools.partial(tf.function, jit_compile=jit_compile, reduce_retracing=True)
 
 
 class ComplexLayer(ABC):
@@ -187,11 +204,11 @@ class ComplexInput(InputLayer, ComplexLayer):
 class ComplexFlatten(Flatten, ComplexLayer):
     def call(self, inputs: t_input):
         # tf.print(f"inputs at ComplexFlatten are {inputs.dtype}")
-        real_flat = super(ComplexFlatten, self).call(tf.math.real(inputs))
-        imag_flat = super(ComplexFlatten, self).call(tf.math.imag(inputs))
-        return tf.cast(
-            tf.complex(real_flat, imag_flat), inputs.dtype
-        )  # Keep input dtype
+        if self.data_format == "channels_last" and inputs.shape[1:].is_fully_defined():
+            # Batch size left as -1 so the reshape does not depend on it (no retracing for new batch sizes)
+            return tf.reshape(inputs, [-1, inputs.shape[1:].num_elements()])
+        # Transpose and reshape are dtype agnostic, no need to split into real and imaginary parts.
+        return super(ComplexFlatten, self).call(inputs)
 
     def get_real_equivalent(self):
         # Dtype agnostic so just init one.
@@ -234,7 +251,7 @@ class ComplexDense(Dense, ComplexLayer):
             Recommended to use a `ComplexInitializer` such as `cvnn.initializers.ComplexGlorotUniform()` (default)
         :param bias_initializer: Initializer for the bias vector.
             Recommended to use a `ComplexInitializer` such as `cvnn.initializers.Zeros()` (default)
-        :param dtype: Dtype of the input and layer.
+        :param dtype: Dtype of the input and layer. Either complex64 (default) or float32.
         :param init_technique: One of 'mirror' or 'zero_imag'. Tells the initializer how to init complex number if
             the initializer was tensorflow's built in initializers (not supporting complex numbers).
             - 'mirror': Uses the initializer for both real and imaginary part.
@@ -256,6 +273,8 @@ class ComplexDense(Dense, ComplexLayer):
         )
         # !Cannot override dtype of the layer because it has a read-only @property
         self.my_dtype = tf.dtypes.as_dtype(dtype)
+        if self.my_dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Unsupported dtype {self.my_dtype}, supported dtypes are {SUPPORTED_DTYPES}")
         self.init_technique = init_technique.lower()
 
     def build(self, input_shape):
@@ -364,18 +383,34 @@ class ComplexDense(Dense, ComplexLayer):
                 )
             inputs = tf.cast(inputs, self.my_dtype)
         if self.my_dtype.is_complex:
-            w = tf.complex(self.w_r, self.w_i)
-            if self.use_bias:
-                b = tf.complex(self.b_r, self.b_i)
-        else:
-            w = self.w
-            if self.use_bias:
-                b = self.b
-        out = tf.matmul(inputs, w)
+            return self.dense_op(inputs)
+        # Real path kept on the same kernels as tf.keras.layers.Dense so both give bit-exact results
+        out = tf.matmul(inputs, self.w)
         if self.use_bias:
-            out = out + b
+            out = out + self.b
         return self.activation(out)
 
+    @layer_function()
+    def dense_op(self, inputs):
+        """
+        Computes `activation(input * weights + bias)` for complex inputs (XLA-compiled if CVNN_JIT=1).
+        :param inputs: Complex tensor already casted to the layer dtype.
+        """
+        # Contraction over the last axis only, so inputs of any rank (batch, ..., features) are supported
+        # Gauss trick: 3 real products instead of the 4 of a complex product.
+        inputs_r = tf.math.real(inputs)
+        inputs_i = tf.math.imag(inputs)
+        k1 = tf.einsum("...i,io->...o", inputs_r, self.w_r)
+        k2 = tf.einsum("...i,io->...o", inputs_i, self.w_i)
+        k3 = tf.einsum("...i,io->...o", inputs_r + inputs_i, self.w_r + self.w_i)
+        out_r = k1 - k2
+        out_i = k3 - k1 - k2
+        if self.use_bias:
+            # BiasAdd instead of a broadcasted add, XLA fuses it as the matmul epilogue
+            out_r = tf.nn.bias_add(out_r, self.b_r)
+            out_i = tf.nn.bias_add(out_i, self.b_i)
+        return self.activation(tf.complex(out_r, out_i))
+
     def get_real_equivalent(self, output_multiplier=2):
         # assert self.my_dtype.is_complex, "The layer was already real!"    # TODO: Shall I check this?
         # TODO: Does it pose a problem not to re-create an object of the initializer?
@@ -418,7 +453,7 @@ class ComplexDropout(Layer, ComplexLayer):
         self, rate: float, noise_shape=None, seed: Optional[int] = None, **kwargs
     ):
         """
-        :param rate: Float between 0 and 1. Fraction of the input units to drop.
+        :param rate: Float in [0, 1). Fraction of the input units to drop.
         :param noise_shape: 1D integer tensor representing the shape of the binary dropout mask that
             will be multiplied with the input.
             For instance, if your inputs have shape `(batch_size, timesteps, features)` and you want the dropout
@@ -426,9 +461,10 @@ class ComplexDropout(Layer, ComplexLayer):
         :param seed: A Python integer to use as random seed.
         """
         super(ComplexDropout, self).__init__(**kwargs)  # trainable=False,
-        if isinstance(rate, (int, float)) and not 0 <= rate <= 1:
+        if isinstance(rate, numbers.Real) and not 0 <= rate < 1:
+            # rate == 1 would drop every unit and divide by zero when scaling the kept ones.
             raise ValueError(
-                f"Invalid value {rate} received for `rate`, expected a value between 0 and 1."
+                f"Invalid value {rate} received for `rate`, expected a value in [0, 1)."
             )
         self.rate = rate
         self.seed = seed
@@ -470,15 +506,13 @@ class ComplexDropout(Layer, ComplexLayer):
         # return output
         if not training:
             return inputs
-        drop_filter = tf.nn.dropout(
-            tf.ones(tf.shape(inputs)),
-            rate=self.rate,
-            noise_shape=self.noise_shape,
-            seed=self.seed,
-        )
-        y_out = tf.multiply(tf.cast(drop_filter, dtype=inputs.dtype), inputs)
-        y_out = tf.cast(y_out, dtype=inputs.dtype)
-        return y_out
+        noise_shape = self._get_noise_shape(inputs)     # Resolves the None entries of noise_shape
+        if noise_shape is None:
+            noise_shape = tf.shape(inputs)
+        # Same mask as tf.nn.dropout but applied with a single multiplication on the (complex) input.
+        keep = tf.cast(tf.random.uniform(noise_shape, seed=self.seed) >= self.rate, tf.float32)
+        keep = keep * (1. / (1. - self.rate))
+        return inputs * tf.cast(keep, dtype=inputs.dtype)
 
     def compute_output_shape(self, input_shape):
         return input_shape
@@ -635,7 +669,9 @@ class ComplexBatchNormalization(Layer, ComplexLayer):
             # I trust K.learning_phase() returns a correct boolean.
         if training:
             # First get the mean and var
-            mean = tf.math.reduce_mean(inputs, axis=self.used_axis)
+            # Reduced axes kept for the centering (broadcasts right whatever the position of self.axis)
+            keepdims_mean = tf.math.reduce_mean(inputs, axis=self.used_axis, keepdims=True)
+            mean = tf.squeeze(keepdims_mean, axis=self.used_axis)
             if self.cov_method == 1:
                 X_20 = tf.concat((tf.math.real(inputs), tf.math.imag(inputs)), axis=-1)
                 var_20_20 = tfp.stats.covariance(
@@ -653,9 +689,7 @@ class ComplexBatchNormalization(Layer, ComplexLayer):
                 var_10_2_2 = tfp.stats.covariance(X_10_2, sample_axis=self.used_axis, event_axis=-1)
                 var = var_10_2_2
                 """
-                centered_inputs = inputs - tf.math.reduce_mean(
-                    inputs, axis=self.used_axis, keepdims=True
-                )
+                centered_inputs = inputs - keepdims_mean  # Reuse the mean already computed above
                 Crr = tf.math.reduce_mean(
                     tf.math.real(centered_inputs) ** 2, axis=self.used_axis
                 )
@@ -666,12 +700,12 @@ class ComplexBatchNormalization(Layer, ComplexLayer):
                     tf.math.real(centered_inputs) * tf.math.imag(centered_inputs),
                     axis=self.used_axis,
                 )
-                s1 = tf.stack([Crr, Cri], axis=1)
-                s2 = tf.stack([Cri, Cii], axis=1)
-                var = tf.stack([s1, s2], axis=2)
+                s1 = tf.stack([Crr, Cri], axis=-1)
+                s2 = tf.stack([Cri, Cii], axis=-1)
+                var = tf.stack([s1, s2], axis=-1)
 
             else:
-                raise ValueError(f"Method {self.method} not implemented")
+                raise ValueError(f"Method {self.cov_method} not implemented")
 
             # Now the train part with these values
             self.moving_mean.assign(
@@ -706,10 +740,7 @@ class ComplexBatchNormalization(Layer, ComplexLayer):
         :param mean: Tensor with the mean in the corresponding dtype (same shape as inputs)
         """
         complex_zero_mean = inputs - mean
-        # Inv and sqrtm is done over 2 inner most dimension [..., M, M] so it should be [..., 2, 2] for us.
-        inv_sqrt_var = tf.linalg.sqrtm(
-            tf.linalg.inv(var + self.epsilon_matrix)
-        )  # var^(-1/2)  # TODO: Check this exists always?
+        inv_sqrt_var = self._inverse_sqrt_2x2(var + self.epsilon_matrix)  # var^(-1/2)
         # Separate real and imag so I go from shape [...] to [..., 2]
         zero_mean = tf.stack(
             (tf.math.real(complex_zero_mean), tf.math.imag(complex_zero_mean)), axis=-1
@@ -718,8 +749,8 @@ class ComplexBatchNormalization(Layer, ComplexLayer):
         inputs_hat = tf.matmul(inv_sqrt_var, tf.expand_dims(zero_mean, axis=-1))
 
         # Then I squeeze to remove the last shape so I go from [..., 2, 1] to [..., 2].
-        # Use reshape and not squeeze in case I have 1 channel for example.
-        squeeze_inputs_hat = tf.reshape(inputs_hat, shape=tf.shape(inputs_hat)[:-1])
+        # Explicit axis so other size 1 dimensions (1 channel for example) are kept, no dynamic shape needed.
+        squeeze_inputs_hat = tf.squeeze(inputs_hat, axis=-1)
         # Get complex data
         complex_inputs_hat = tf.cast(
             tf.complex(squeeze_inputs_hat[..., 0], squeeze_inputs_hat[..., 1]),
@@ -728,6 +759,25 @@ class ComplexBatchNormalization(Layer, ComplexLayer):
         # import pdb; pdb.set_trace()
         return complex_inputs_hat
 
+    @staticmethod
+    def _inverse_sqrt_2x2(var):
+        """
+        Closed form of the inverse square root of symmetric positive definite matrices [..., 2, 2].
+        Element-wise ops only, instead of a general tf.linalg.sqrtm(tf.linalg.inv(var)) per matrix.
+        With s = sqrt(det(var)) and t = sqrt(trace(var) + 2s): var^(-1/2) = [[d + s, -b], [-b, a + s]] / (s t)
+        :param var: Tensor of shape [..., 2, 2] with var = [[a, b], [b, d]]
+        """
+        a = var[..., 0, 0]
+        b = var[..., 0, 1]
+        d = var[..., 1, 1]
+        s = tf.math.sqrt(a * d - b * b)
+        t = tf.math.sqrt(a + d + 2. * s)
+        denominator = s * t
+        return tf.stack([
+            tf.stack([(d + s) / denominator, -b / denominator], axis=-1),
+            tf.stack([-b / denominator, (a + s) / denominator], axis=-1)
+        ], axis=-2)
+
     """@staticmethod
     def _normalize_real(inputs, var, mean):
         numerator = inputs - mean
@@ -52,24 +52,28 @@ class ComplexPooling2D(Layer, ComplexLayer):
         self.padding = conv_utils.normalize_padding(padding)
         self.data_format = conv_utils.normalize_data_format(data_format)
         self.input_spec = InputSpec(ndim=4)
+        # Arguments of the pool function do not change between calls.
+        # Pooling always runs on NHWC, the only layout supported by every pooling kernel (on CPU and with argmax).
+        self._pool_shape = (1,) + self.pool_size + (1,)
+        self._pool_strides = (1,) + self.strides + (1,)
+        self._tf_padding = self.padding.upper()
+        self._tf_data_format = 'NHWC'
 
     @abstractmethod
     def pool_function(self, inputs, ksize, strides, padding, data_format):
         pass
 
     def call(self, inputs, **kwargs):
-        if self.data_format == 'channels_last':
-            pool_shape = (1,) + self.pool_size + (1,)
-            strides = (1,) + self.strides + (1,)
-        else:
-            pool_shape = (1, 1) + self.pool_size
-            strides = (1, 1) + self.strides
+        if self.data_format == 'channels_first':
+            inputs = tf.transpose(inputs, perm=(0, 2, 3, 1))
         outputs = self.pool_function(
             inputs,
-            ksize=pool_shape,
-            strides=strides,
-            padding=self.padding.upper(),
-            data_format=conv_utils.convert_data_format(self.data_format, 4))
+            ksize=self._pool_shape,
+            strides=self._pool_strides,
+            padding=self._tf_padding,
+            data_format=self._tf_data_format)
+        if self.data_format == 'channels_first':
+            outputs = tf.transpose(outputs, perm=(0, 3, 1, 2))
         return outputs
 
     def compute_output_shape(self, input_shape):
@@ -117,6 +121,27 @@ class ComplexMaxPooling2D(ComplexPooling2D):
                                                   data_format=data_format, name=name, **kwargs)
         self.argmax = None
 
+    def call(self, inputs, **kwargs):
+        outputs = super(ComplexMaxPooling2D, self).call(inputs, **kwargs)
+        if self.data_format == 'channels_first':
+            self.argmax = self._channels_first_argmax(self.argmax, tf.shape(inputs, out_type=tf.int64))
+        return outputs
+
+    @staticmethod
+    def _channels_first_argmax(argmax, input_shape):
+        """
+        Pooling runs on NHWC, so argmax has the NHWC shape and flattened NHWC indices (batch included).
+        :param argmax: Argmax returned by tf.nn.max_pool_with_argmax.
+        :param input_shape: Shape of the channels_first (NCHW) input of the layer.
+        :return: argmax with the NCHW shape and the flattened indices of the NCHW input.
+        """
+        channels = input_shape[1]
+        image_size = input_shape[2] * input_shape[3]
+        argmax = tf.transpose(argmax, perm=(0, 3, 1, 2))
+        channel = argmax % channels
+        pixel = argmax // channels      # batch * H * W + row * W + col
+        return (pixel // image_size * channels + channel) * image_size + pixel % image_size
+
     def pool_function(self, inputs, ksize, strides, padding, data_format):
         # The max is calculated with the absolute value. This will still work on real values.
         if inputs.dtype.is_complex:
@@ -130,7 +155,6 @@ class ComplexMaxPooling2D(ComplexPooling2D):
         shape = tf.shape(output)
         tf_res = tf.reshape(tf.gather(tf.reshape(inputs, [-1]), argmax), shape)
         # assert np.all(tf_res == output)             # For debugging when the input is real only!
-        assert tf_res.dtype == inputs.dtype
         return tf_res
 
     def get_real_equivalent(self):
@@ -151,33 +175,16 @@ class ComplexMaxPooling2DWithArgmax(ComplexMaxPooling2D):
     Works for complex dtype using the absolute value to get the max.
     """
 
-    def pool_function(self, inputs, ksize, strides, padding, data_format):
+    def call(self, inputs, **kwargs):
         """
         :param inputs: A Tensor. Input to pool over.
-        :param ksize: An int or list of ints that has length 1, 2 or 4.
-            The size of the window for each dimension of the input tensor.
-        :param strides: An int or list of ints that has length 1, 2 or 4.
-            The stride of the sliding window for each dimension of the input tensor.
-        :param padding: A string from: "SAME", "VALID". The type of padding algorithm to use.
-        :param data_format: An optional string, must be set to "NHWC". Defaults to "NHWC".
-            Specify the data format of the input and output data.
         :return: A tuple of Tensor objects (output, argmax).
             - output	A Tensor. Has the same type as input.
-            - argmax	A Tensor. The indices in argmax are flattened (Complains directly to TensorFlow)
+            - argmax	A Tensor. The indices in argmax are flattened (Complains directly to TensorFlow).
+                For channels_first they index the flattened channels_first input.
         """
-        # The max is calculated with the absolute value. This will still work on real values.
-        if inputs.dtype.is_complex:
-            abs_in = tf.math.abs(inputs)
-        else:
-            abs_in = inputs
-        output, argmax = tf.nn.max_pool_with_argmax(input=abs_in, ksize=ksize, strides=strides,
-                                                    padding=padding, data_format=data_format,
-                                                    include_batch_in_index=True)
-        shape = tf.shape(output)
-        tf_res = tf.reshape(tf.gather(tf.reshape(inputs, [-1]), argmax), shape)
-        # assert np.all(tf_res == output)             # For debugging when the input is real only!
-        assert tf_res.dtype == inputs.dtype
-        return tf_res, argmax
+        outputs = super(ComplexMaxPooling2DWithArgmax, self).call(inputs, **kwargs)
+        return outputs, self.argmax
 
 
 class ComplexAvgPooling2D(ComplexPooling2D):
@@ -311,8 +318,9 @@ class ComplexUnPooling2D(Layer, ComplexLayer):
                 raise ValueError('output_shape should be passed as 3rd element or either desired_output_shape '
                                  'or upsampling_factor should be passed on construction')
             if inputs_values.get_shape()[1:].is_fully_defined():
-                output_shape = tf.tile(inputs_values,
-                                       [1, self.upsampling_factor, self.upsampling_factor, 1]).get_shape()[1:]
+                # Static shape arithmetic, no need to run (or trace) a tf.tile just to know the output shape
+                h, w, c = inputs_values.get_shape()[1:]
+                output_shape = [h * self.upsampling_factor, w * self.upsampling_factor, c]
             else:
                 output_shape = tf.shape(inputs_values)[1:]
         elif self.upsampling_factor is not None:
@@ -353,7 +361,7 @@ class ComplexPooling3D(Layer, ComplexLayer):
     def __init__(self, pool_size=(2, 2, 1), strides=None,
                  padding='valid', data_format='channels_last',
                  name=None, dtype=DEFAULT_COMPLEX_TYPE, **kwargs):
-        self.my_dtype = dtype
+        self.my_dtype = tf.dtypes.as_dtype(dtype)
         super(ComplexPooling3D, self).__init__(name=name, **kwargs)
         if data_format is None:
             data_format = backend.image_data_format()
@@ -364,6 +372,8 @@ class ComplexPooling3D(Layer, ComplexLayer):
         self.padding = conv_utils.normalize_padding(padding)
         self.data_format = conv_utils.normalize_data_format(data_format)
         self.input_spec = InputSpec(ndim=5)
+        self._tf_padding = self.padding.upper()
+        self._tf_data_format = conv_utils.convert_data_format(self.data_format, 5)
 
     @abstractmethod
     def pool_function(self, inputs, ksize, strides, padding, data_format):
@@ -374,22 +384,15 @@ class ComplexPooling3D(Layer, ComplexLayer):
             inputs,
             self.pool_size,
             strides=self.strides,
-            padding=self.padding.upper(),
-            data_format=conv_utils.convert_data_format(self.data_format, 5))
+            padding=self._tf_padding,
+            data_format=self._tf_data_format)
         return outputs
 
     def compute_output_shape(self, input_shape):
         input_shape = tensor_shape.TensorShape(input_shape).as_list()
-        if self.data_format == 'channels_first':
-            deps = input_shape[-3]
-            rows = input_shape[-2]
-            cols = input_shape[-1]
-        else:
-            deps = input_shape[-4]
-            rows = input_shape[-3]
-            cols = input_shape[-2]
-        rows = conv_utils.conv_output_length(rows, self.pool_size[0], self.padding, self.strides[0])
-        cols = conv_utils.conv_output_length(cols, self.pool_size[1], self.padding, self.strides[1])
+        spatial = input_shape[2:] if self.data_format == 'channels_first' else input_shape[1:-1]
+        deps, rows, cols = [conv_utils.conv_output_length(length, pool, self.padding, stride)
+                            for length, pool, stride in zip(spatial, self.pool_size, self.strides)]
         if self.data_format == 'channels_first':
             return tensor_shape.TensorShape(
                 [input_shape[0], input_shape[1], deps, rows, cols])
@@ -438,7 +441,7 @@ class ComplexPooling1D(Layer, ComplexLayer):
     def __init__(self, pool_size=2, strides=None,
                  padding='valid', data_format='channels_last',
                  name=None, dtype=DEFAULT_COMPLEX_TYPE, **kwargs):
-        self.my_dtype = dtype
+        self.my_dtype = tf.dtypes.as_dtype(dtype)
         super(ComplexPooling1D, self).__init__(name=name, **kwargs)
         if data_format is None:
             data_format = backend.image_data_format()
@@ -449,6 +452,8 @@ class ComplexPooling1D(Layer, ComplexLayer):
         self.padding = conv_utils.normalize_padding(padding)
         self.data_format = conv_utils.normalize_data_format(data_format)
         self.input_spec = InputSpec(ndim=3)
+        self._tf_padding = self.padding.upper()
+        self._tf_data_format = conv_utils.convert_data_format(self.data_format, 3)
 
     @abstractmethod
     def pool_function(self, inputs, ksize, strides, padding, data_format):
@@ -459,8 +464,8 @@ class ComplexPooling1D(Layer, ComplexLayer):
             inputs,
             self.pool_size,
             strides=self.strides,
-            padding=self.padding.upper(),
-            data_format=conv_utils.convert_data_format(self.data_format, 3))
+            padding=self._tf_padding,
+            data_format=self._tf_data_format)
         return outputs
 
     def compute_output_shape(self, input_shape):
@@ -28,12 +28,17 @@ class ComplexUpSampling2D(UpSampling2D, ComplexLayer):
                                                   dtype=self.my_dtype.real_dtype, **kwargs)
 
     def call(self, inputs):
-        result = tf.complex(
-            backend.resize_images(tf.math.real(inputs), self.size[0], self.size[1], self.data_format,
-                                  interpolation=self.interpolation),
-            backend.resize_images(tf.math.imag(inputs), self.size[0], self.size[1], self.data_format,
-                                  interpolation=self.interpolation),
-        )
+        if self.interpolation == 'nearest':
+            # Integer factors, so nearest neighbour is just repeating the pixels. Done on the complex tensor at once.
+            h_axis, w_axis = (2, 3) if self.data_format == 'channels_first' else (1, 2)
+            result = tf.repeat(tf.repeat(inputs, self.size[0], axis=h_axis), self.size[1], axis=w_axis)
+        else:
+            result = tf.complex(
+                backend.resize_images(tf.math.real(inputs), self.size[0], self.size[1], self.data_format,
+                                      interpolation=self.interpolation),
+                backend.resize_images(tf.math.imag(inputs), self.size[0], self.size[1], self.data_format,
+                                      interpolation=self.interpolation),
+            )
         casted_value = inputs.dtype if not inputs.dtype.is_integer else tf.float32
         return tf.cast(result, dtype=casted_value)
 
@@ -1,4 +1,3 @@
-import sys
 import numpy as np
 from tensorflow.keras import Sequential
 from pdb import set_trace
@@ -62,7 +61,7 @@ def get_real_equivalent(complex_model: Type[Sequential], classifier: bool = True
     equiv_technique = equiv_technique.lower()
     if equiv_technique not in {"ratio", "alternate"}:
         logger.error("Invalid `equivalent_technique` argument: " + equiv_technique)
-        sys.exit(-1)
+        raise ValueError(f"Invalid equiv_technique {equiv_technique}, expected one of 'ratio' or 'alternate'")
     # assert len(self.shape) != 0
     real_input_shape = [inp for inp in complex_model.layers[0].input_shape if inp is not None]
     real_input_shape[-1] = real_input_shape[-1]*2
@@ -80,7 +79,7 @@ def get_real_equivalent(complex_model: Type[Sequential], classifier: bool = True
             else:
                 real_shape.append(layer.get_real_equivalent())
         else:
-            sys.exit("Layer " + str(layer) + " unknown")
+            raise ValueError("Layer " + str(layer) + " unknown")
     assert counter == len(output_multiplier)
     if name is None:
         name = f"{complex_model.name}_real_equiv"
@@ -2,7 +2,6 @@ import numpy as np
 from datetime import datetime
 from pathlib import Path
 from pdb import set_trace
-import sys
 from tensorflow.python.keras import Model
 import tensorflow as tf     # TODO: Imported only for dtype
 import os
@@ -82,7 +81,7 @@ def cast_to_path(path):
         path = Path(path)
     elif not isinstance(path, Path):
         logger.error("Path datatype not recognized")
-        sys.exit(-1)
+        raise TypeError(f"Path datatype {type(path)} not recognized")
     return path
 
 
@@ -98,7 +97,7 @@ def get_func_name(fun):
         return fun
     else:
         logger.error("Function not recognizable", stack_info=True)
-        sys.exit(-1)
+        raise TypeError(f"Function {fun} not recognizable")
 
 
 def transform_to_real_map_function(image, label, mode: str = "real_imag"):
@@ -204,6 +203,20 @@ def median_error(q_75: float, q_25: float, n: int) -> int:
     return 1.57*(q_75-q_25)/np.sqrt(n)
 
 
+def batched_call(layer, xs):
+    """
+    Applies the layer to each example of xs independently using `tf.vectorized_map`.
+    Useful inside a `tf.GradientTape` to get per-example outputs (and therefore per-example gradients)
+    while still running vectorized batched ops instead of a python loop.
+    :param layer: Keras layer (or model) to be applied.
+    :param xs: Batched input tensor, the first dimension is the example index.
+    :return: Tensor with the output of the layer for each example stacked along the first dimension.
+    """
+    if not layer.built:
+        layer(xs[:1])   # Build the weights outside vectorized_map
+    return tf.vectorized_map(lambda x: layer(tf.expand_dims(x, axis=0))[0], xs)
+
+
 if __name__ == "__main__":
     logger.warning("Testing logger")
 
@@ -1,11 +1,13 @@
+import functools
 import numpy as np
+import pytest
 from cvnn.layers import ComplexDense, ComplexFlatten, ComplexInput, ComplexConv2D, ComplexMaxPooling2D, \
     ComplexAvgPooling2D, ComplexConv2DTranspose, ComplexUnPooling2D, ComplexMaxPooling2DWithArgmax, \
-    ComplexUpSampling2D, ComplexBatchNormalization, ComplexAvgPooling1D
+    ComplexUpSampling2D, ComplexBatchNormalization, ComplexAvgPooling1D, ComplexAvgPooling3D
 import cvnn.layers as complex_layers
+from cvnn.utils import batched_call
 from tensorflow.keras.models import Sequential
 import tensorflow as tf
-import tensorflow_datasets as tfds
 
 from pdb import set_trace
 
@@ -21,39 +23,193 @@ This module tests:
 """
 
 
+def _make_complex(r, i):
+    """Builds the complex64 array r + 1j*i writing each element once (no complex128 temporaries)."""
+    out = np.empty(np.shape(r), dtype=np.complex64)
+    out.real = r
+    out.imag = i
+    return out
+
+
+def _tensors_equal(a, b):
+    """Exact comparison done on the device, only the final boolean is copied to the host."""
+    a = tf.convert_to_tensor(a)
+    b = tf.convert_to_tensor(b)
+    assert a.dtype == b.dtype, f"{a.dtype} != {b.dtype}"
+    return bool(tf.reduce_all(tf.equal(a, b)).numpy())
+
+
+# Test images, built once for the whole module and in the layout used (they are never modified by the tests).
+_IMG_R_3x3 = np.array([[
+    [0, 1, 2],
+    [0, 2, 2],
+    [0, 5, 7]
+], [
+    [0, 4, 5],
+    [3, 7, 9],
+    [4, 5, 3]
+]], dtype=np.float32)
+_IMG_I_3x3 = np.array([[
+    [0, 4, 5],
+    [3, 7, 9],
+    [4, 5, 3]
+], [
+    [0, 4, 5],
+    [3, 7, 9],
+    [4, 5, 3]
+]], dtype=np.float32)
+_IMG_C64 = _make_complex(_IMG_R_3x3, _IMG_I_3x3)
+_POOL_IMG_R = np.array([[
+    [0, 1, 2],
+    [0, 2, 2],
+    [0, 5, 7]
+], [
+    [0, 7, 5],
+    [3, 7, 9],
+    [4, 5, 3]
+]], dtype=np.float32)
+_POOL_IMG_I = np.array([[
+    [0, 4, 5],
+    [3, 7, 9],
+    [4, 5, 3]
+], [
+    [0, 4, 5],
+    [3, 2, 2],
+    [4, 8, 9]
+]], dtype=np.float32)
+_IMG_1D_R = np.array([[
+    [0, 1, 2, 0, 2, 2, 0, 5, 7]
+], [
+    [0, 4, 5, 3, 7, 9, 4, 5, 3]
+]], dtype=np.float32).reshape((2, 9, 1))
+_IMG_1D_I = np.array([[
+    [0, 4, 5, 3, 7, 9, 4, 5, 3]
+], [
+    [0, 4, 5, 3, 2, 2, 4, 8, 9]
+]], dtype=np.float32).reshape((2, 9, 1))
+
+# Expected results, complex64 like the layer outputs they are compared to.
+_EXPECTED_AVG_POOL_1D = np.array([[0.5 + 2.j, 1. + 4.j, 2. + 8.j, 2.5 + 4.5j],
+                                  [2. + 2.j, 4. + 4.j, 8. + 2.j, 4.5 + 6.j]], dtype=np.complex64)[..., np.newaxis]
+_EXPECTED_MAX_POOL_2D = np.array([
+    [[
+        [2. + 7.j],
+        [2. + 9.j]],
+        [[2. + 7.j],
+         [2. + 9.j]]],
+    [[
+        [7. + 4.j],
+        [9. + 2.j]],
+        [
+            [5. + 8.j],
+            [3. + 9.j]]]
+], dtype=np.complex64)
+_EXPECTED_MAX_UNPOOL_2D = np.array([[[0. + 0.j, 0. + 0.j, 0. + 0.j],
+                                     [0. + 0.j, 4. + 14.j, 4. + 18.j],
+                                     [0. + 0.j, 0. + 0.j, 0. + 0.j]],
+                                    [[0. + 0.j, 7. + 4.j, 0. + 0.j],
+                                     [0. + 0.j, 0. + 0.j, 9. + 2.j],
+                                     [0. + 0.j, 5. + 8.j, 3. + 9.j]]], dtype=np.complex64).reshape(2, 3, 3, 1)
+_EXPECTED_AVG_POOL_2D = np.array([[[[0.75 + 3.5j], [1.75 + 6.25j]], [[1.75 + 4.75j], [4. + 6.j]]],
+                                  [[[4.25 + 2.25j], [7 + 3.25j]], [[4.75 + 4.25j], [6. + 5.25j]]]], dtype=np.complex64)
+_EXPECTED_NEAREST_UPSAMPLING_2_3 = np.array([[[[0. + 0.j, 1. + 1.j, 2. + 2.j],
+                                               [0. + 0.j, 1. + 1.j, 2. + 2.j],
+                                               [0. + 0.j, 1. + 1.j, 2. + 2.j]],
+                                              [[0. + 0.j, 1. + 1.j, 2. + 2.j],
+                                               [0. + 0.j, 1. + 1.j, 2. + 2.j],
+                                               [0. + 0.j, 1. + 1.j, 2. + 2.j]],
+                                              [[3. + 3.j, 4. + 4.j, 5. + 5.j],
+                                               [3. + 3.j, 4. + 4.j, 5. + 5.j],
+                                               [3. + 3.j, 4. + 4.j, 5. + 5.j]],
+                                              [[3. + 3.j, 4. + 4.j, 5. + 5.j],
+                                               [3. + 3.j, 4. + 4.j, 5. + 5.j],
+                                               [3. + 3.j, 4. + 4.j, 5. + 5.j]]],
+                                             [[[6. + 6.j, 7. + 7.j, 8. + 8.j],
+                                               [6. + 6.j, 7. + 7.j, 8. + 8.j],
+                                               [6. + 6.j, 7. + 7.j, 8. + 8.j]],
+                                              [[6. + 6.j, 7. + 7.j, 8. + 8.j],
+                                               [6. + 6.j, 7. + 7.j, 8. + 8.j],
+                                               [6. + 6.j, 7. + 7.j, 8. + 8.j]],
+                                              [[9. + 9.j, 10. + 10.j, 11. + 11.j],
+                                               [9. + 9.j, 10. + 10.j, 11. + 11.j],
+                                               [9. + 9.j, 10. + 10.j, 11. + 11.j]],
+                                              [[9. + 9.j, 10. + 10.j, 11. + 11.j],
+                                               [9. + 9.j, 10. + 10.j, 11. + 11.j],
+                                               [9. + 9.j, 10. + 10.j, 11. + 11.j]]]], dtype=np.complex64)
+_EXPECTED_NEAREST_UPSAMPLING_1_3 = np.array([[[[0. + 0.j, 1. + 1.j, 2. + 2.j],
+                                               [0. + 0.j, 1. + 1.j, 2. + 2.j],
+                                               [0. + 0.j, 1. + 1.j, 2. + 2.j]],
+                                              [[3. + 3.j, 4. + 4.j, 5. + 5.j],
+                                               [3. + 3.j, 4. + 4.j, 5. + 5.j],
+                                               [3. + 3.j, 4. + 4.j, 5. + 5.j]]],
+                                             [[[6. + 6.j, 7. + 7.j, 8. + 8.j],
+                                               [6. + 6.j, 7. + 7.j, 8. + 8.j],
+                                               [6. + 6.j, 7. + 7.j, 8. + 8.j]],
+                                              [[9. + 9.j, 10. + 10.j, 11. + 11.j],
+                                               [9. + 9.j, 10. + 10.j, 11. + 11.j],
+                                               [9. + 9.j, 10. + 10.j, 11. + 11.j]]]], dtype=np.complex64)
+
+# Small upsampling inputs, channels_first.
+_X_2x2 = tf.constant([[[[1., 2.], [3., 4.]]]], dtype=tf.float32)
+_Z_2x2 = tf.complex(_X_2x2, _X_2x2)
+_X_3x3_PADDED = tf.constant([[[[1., 2., 0.],
+                               [3., 4., 0.],
+                               [0., 0., 0.]]]], dtype=tf.float32)
+_Z_3x3_PADDED = tf.complex(_X_3x3_PADDED, _X_3x3_PADDED)
+
+
 @tf.autograph.experimental.do_not_convert
 def dense_example():
-    img_r = np.array([[
-        [0, 1, 2],
-        [0, 2, 2],
-        [0, 5, 7]
-    ], [
-        [0, 4, 5],
-        [3, 7, 9],
-        [4, 5, 3]
-    ]]).astype(np.float32)
-    img_i = np.array([[
-        [0, 4, 5],
-        [3, 7, 9],
-        [4, 5, 3]
-    ], [
-        [0, 4, 5],
-        [3, 7, 9],
-        [4, 5, 3]
-    ]]).astype(np.float32)
-    img = img_r + 1j * img_i
+    img = _IMG_C64
     c_flat = ComplexFlatten()
     c_dense = ComplexDense(units=10)
-    res = c_dense(c_flat(img.astype(np.complex64)))
+    res = c_dense(c_flat(img))
     assert res.shape == [2, 10]
     assert res.dtype == tf.complex64
+    expected = tf.matmul(c_flat(img), tf.complex(c_dense.w_r, c_dense.w_i)) + tf.complex(c_dense.b_r, c_dense.b_i)
+    assert np.allclose(res, expected, atol=1e-5)
     model = tf.keras.models.Sequential()
     model.add(ComplexInput(input_shape=(3, 3)))
     model.add(ComplexFlatten())
     model.add(ComplexDense(32, activation='cart_relu'))
     model.add(ComplexDense(32))
     assert model.output_shape == (None, 32)
-    res = model(img.astype(np.complex64))
+    res = model(img)
+
+
+def flatten_reuse():
+    flatten = ComplexFlatten()
+    for shape in ((2, 3, 3), (2, 3, 6), (5, 4)):
+        z = tf.complex(tf.ones(shape), tf.ones(shape))
+        assert flatten(z).shape == tf.keras.layers.Flatten()(tf.math.real(z)).shape
+
+
+def dense_serialization():
+    layer = ComplexDense(units=4)
+    config = layer.get_config()
+    assert ComplexDense.from_config(config).get_config() == config
+    model = tf.keras.models.Sequential([ComplexInput(input_shape=(3,)), ComplexDense(4)])
+    assert tf.keras.models.clone_model(model).output_shape == (None, 4)
+
+
+def dropout_rate():
+    for rate in (-0.1, 1., 1.5, np.float32(1.)):
+        with pytest.raises(ValueError):
+            complex_layers.ComplexDropout(rate)
+    assert complex_layers.ComplexDropout(0.).rate == 0.
+
+
+@tf.autograph.experimental.do_not_convert
+def dropout_noise_shape():
+    tf.random.set_seed(0)
+    layer = complex_layers.ComplexDropout(.5, noise_shape=(None, 1, 4), seed=0)
+    data = tf.complex(tf.ones((3, 5, 4)), tf.ones((3, 5, 4)))
+    outputs = layer(data, training=True)
+    assert outputs.shape == data.shape
+    assert np.all((outputs == 0) | (outputs == 2. + 2.j))
+    # The mask is shared along axis 1 (noise_shape 1) and the None entry takes the batch size.
+    assert np.all(outputs == outputs[:, :1, :])
+    assert np.any(outputs == 0) and np.any(outputs != 0)
 
 
 @tf.autograph.experimental.do_not_convert
@@ -63,25 +219,7 @@ def serial_layers():
     model.add(ComplexDense(32))
     print(model.output_shape)
 
-    img_r = np.array([[
-        [0, 1, 2],
-        [0, 2, 2],
-        [0, 5, 7]
-    ], [
-        [0, 4, 5],
-        [3, 7, 9],
-        [4, 5, 3]
-    ]]).astype(np.float32)
-    img_i = np.array([[
-        [0, 4, 5],
-        [3, 7, 9],
-        [4, 5, 3]
-    ], [
-        [0, 4, 5],
-        [3, 7, 9],
-        [4, 5, 3]
-    ]]).astype(np.float32)
-    img = img_r + 1j * img_i
+    img = _IMG_C64
 
     model = Sequential()
     # model.add(ComplexInput(img.shape[1:]))
@@ -94,19 +232,83 @@ def serial_layers():
 @tf.autograph.experimental.do_not_convert
 def shape_ad_dtype_of_conv2d():
     input_shape = (4, 28, 28, 3)
-    x = tf.cast(tf.random.normal(input_shape), tf.complex64)
-    y = ComplexConv2D(2, 3, activation='cart_relu', padding="same", input_shape=input_shape[1:], dtype=x.dtype)(x)
+    x = tf.complex(tf.random.normal(input_shape), tf.random.normal(input_shape))
+    conv = ComplexConv2D(2, 3, activation='cart_relu', padding="same", input_shape=input_shape[1:], dtype=x.dtype)
+    conv.build(x.shape)     # Create the weights outside the compiled function
+    y = tf.function(conv, jit_compile=True)(x)
     assert y.shape == (4, 28, 28, 2)
     assert y.dtype == tf.complex64
 
 
+@tf.autograph.experimental.do_not_convert
+def complex_conv_2d_value():
+    input_shape = (4, 12, 12, 3)
+    x = tf.complex(tf.random.normal(input_shape), tf.random.normal(input_shape))
+    layer = ComplexConv2D(5, 3, use_bias=False, input_shape=input_shape[1:])
+    y = layer(x)
+    kernel = tf.complex(layer.kernel_r, layer.kernel_i)
+    # Reference: convolution with the complex kernel written as 4 real convolutions
+    expected = tf.complex(
+        tf.nn.conv2d(tf.math.real(x), tf.math.real(kernel), 1, "VALID") -
+        tf.nn.conv2d(tf.math.imag(x), tf.math.imag(kernel), 1, "VALID"),
+        tf.nn.conv2d(tf.math.real(x), tf.math.imag(kernel), 1, "VALID") +
+        tf.nn.conv2d(tf.math.imag(x), tf.math.real(kernel), 1, "VALID")
+    )
+    assert np.allclose(y, expected, atol=1e-5)
+
+
+@tf.autograph.experimental.do_not_convert
+def complex_conv_1d_causal():
+    x = tf.random.stateless_normal((2, 10, 3), seed=(0, 1))
+    for dilation_rate in (1, 2):
+        init = tf.keras.initializers.GlorotUniform(seed=117)
+        conv = tf.keras.layers.Conv1D(4, 3, padding='causal', dilation_rate=dilation_rate, kernel_initializer=init)
+        own_conv = complex_layers.ComplexConv1D(4, 3, padding='causal', dilation_rate=dilation_rate,
+                                                kernel_initializer=init, dtype=np.float32)
+        y = conv(x)
+        own_y = own_conv(x)
+        assert own_y.shape == (2, 10, 4)
+        assert _tensors_equal(y, own_y)
+        # Extra batch dimensions: the causal padding follows the rank of each input
+        x_5 = tf.stack([x] * 5)
+        assert own_conv(x_5).shape == (5, 2, 10, 4)
+        assert _tensors_equal(conv(x_5), own_conv(x_5))
+
+
+def _check_complex_bias(layer, inputs, channel_axis):
+    """The output of a layer with a non-zero complex bias is the one with zero bias plus the bias on `channel_axis`."""
+    layer.build(inputs.shape)
+    bias = tf.complex(tf.range(1., layer.filters + 1.), -tf.range(1., layer.filters + 1.))
+    layer.bias_r.assign(tf.math.real(bias))
+    layer.bias_i.assign(tf.math.imag(bias))
+    with_bias = layer(inputs)
+    layer.bias_r.assign(tf.zeros_like(layer.bias_r))
+    layer.bias_i.assign(tf.zeros_like(layer.bias_i))
+    bias_shape = [1] * with_bias.shape.rank
+    bias_shape[channel_axis] = layer.filters
+    assert np.allclose(with_bias - layer(inputs), tf.reshape(bias, bias_shape), atol=1e-5)
+
+
+def complex_conv_bias():
+    z = tf.complex(tf.random.stateless_normal((2, 10, 3), seed=(0, 2)), tf.random.stateless_normal((2, 10, 3), seed=(0, 3)))
+    _check_complex_bias(complex_layers.ComplexConv1D(4, 3), z, channel_axis=-1)
+    # Rank 1 channels_first takes its own bias branch (tf.nn.bias_add does not accept it)
+    _check_complex_bias(complex_layers.ComplexConv1D(4, 3, data_format='channels_first'),
+                        tf.transpose(z, (0, 2, 1)), channel_axis=1)
+    # Extra batch dimensions
+    _check_complex_bias(complex_layers.ComplexConv1D(4, 3), tf.stack([z] * 2), channel_axis=-1)
+    _check_complex_bias(ComplexConv2D(4, 2), tf.reshape(z, (2, 5, 2, 3)), channel_axis=-1)
+
+
 @tf.autograph.experimental.do_not_convert
 def normalize_img(image, label):
     """Normalizes images: `uint8` -> `float32`."""
     return tf.cast(image, tf.float32) / 255., label
 
 
+@functools.lru_cache(maxsize=1)     # Build the pipeline only once per session
 def get_dataset():
+    import tensorflow_datasets as tfds      # Imported here so only the tests that use MNIST pay for it
     (ds_train, ds_test), ds_info = tfds.load(
         'mnist',
         split=['train', 'test'],
@@ -115,40 +317,23 @@ def get_dataset():
         with_info=True,
     )
 
-    ds_train = ds_train.map(normalize_img, num_parallel_calls=tf.data.experimental.AUTOTUNE)
-    ds_train = ds_train.cache()
+    # Batch before map so normalize_img runs once per batch (vectorized) instead of once per image.
     # ds_train = ds_train.shuffle(ds_info.splits['train'].num_examples)
     ds_train = ds_train.batch(128)
-    ds_train = ds_train.prefetch(tf.data.experimental.AUTOTUNE)
+    ds_train = ds_train.map(normalize_img, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    ds_train = ds_train.cache()
+    ds_train = ds_train.prefetch(tf.data.AUTOTUNE)
 
-    ds_test = ds_test.map(normalize_img, num_parallel_calls=tf.data.experimental.AUTOTUNE)
     ds_test = ds_test.batch(128)
+    ds_test = ds_test.map(normalize_img, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
     ds_test = ds_test.cache()
-    ds_test = ds_test.prefetch(tf.data.experimental.AUTOTUNE)
+    ds_test = ds_test.prefetch(tf.data.AUTOTUNE)
 
     return ds_train, ds_test
 
 
 def get_img():
-    img_r = np.array([[
-        [0, 1, 2],
-        [0, 2, 2],
-        [0, 5, 7]
-    ], [
-        [0, 7, 5],
-        [3, 7, 9],
-        [4, 5, 3]
-    ]]).astype(np.float32)
-    img_i = np.array([[
-        [0, 4, 5],
-        [3, 7, 9],
-        [4, 5, 3]
-    ], [
-        [0, 4, 5],
-        [3, 2, 2],
-        [4, 8, 9]
-    ]]).astype(np.float32)
-    img = img_r + 1j * img_i
+    img = _make_complex(_POOL_IMG_R, _POOL_IMG_I)
     img = np.reshape(img, (2, 3, 3, 1))
     return img
 
@@ -157,36 +342,21 @@ def get_img():
 def complex_avg_pool_1d():
     x = tf.constant([1., 2., 3., 4., 5.])
     x = tf.reshape(x, [1, 5, 1])
-    avg_pool_1d = tf.keras.layers.AveragePooling1D(pool_size=2, strides=1, padding='valid')
-    tf_res = avg_pool_1d(x)
-    own_res = ComplexAvgPooling1D(pool_size=2, strides=1, padding='valid')(x)
-    assert np.all(tf_res.numpy() == own_res.numpy())
-    avg_pool_1d = tf.keras.layers.AveragePooling1D(pool_size=2, strides=2, padding='valid')
-    tf_res = avg_pool_1d(x)
-    own_res = ComplexAvgPooling1D(pool_size=2, strides=2, padding='valid')(x)
-    assert np.all(tf_res.numpy() == own_res.numpy())
-    avg_pool_1d = tf.keras.layers.AveragePooling1D(pool_size=2, strides=1, padding='same')
-    tf_res = avg_pool_1d(x)
-    own_res = ComplexAvgPooling1D(pool_size=2, strides=1, padding='same')(x)
-    assert np.all(tf_res.numpy() == own_res.numpy())
-    img_r = np.array([[
-        [0, 1, 2, 0, 2, 2, 0, 5, 7]
-    ], [
-        [0, 4, 5, 3, 7, 9, 4, 5, 3]
-    ]]).astype(np.float32)
-    img_i = np.array([[
-        [0, 4, 5, 3, 7, 9, 4, 5, 3]
-    ], [
-        [0, 4, 5, 3, 2, 2, 4, 8, 9]
-    ]]).astype(np.float32)
-    img = img_r + 1j * img_i
-    img = np.reshape(img, (2, 9, 1))
+    for strides, padding in ((1, 'valid'), (2, 'valid'), (1, 'same')):
+        avg_pool_1d = tf.keras.layers.AveragePooling1D(pool_size=2, strides=strides, padding=padding)
+        own_avg_pool_1d = ComplexAvgPooling1D(pool_size=2, strides=strides, padding=padding)
+        # Layers are built outside the graph, only their call is traced.
+        avg_pool_1d.build(x.shape)
+        own_avg_pool_1d.build(x.shape)
+        avg_pool_1d = tf.function(avg_pool_1d)
+        own_avg_pool_1d = tf.function(own_avg_pool_1d)
+        tf_res = avg_pool_1d(x)
+        own_res = own_avg_pool_1d(x)
+        assert _tensors_equal(tf_res, own_res)
+    img = _make_complex(_IMG_1D_R, _IMG_1D_I)
     avg_pool = ComplexAvgPooling1D()
-    res = avg_pool(img.astype(np.complex64))
-    expected = tf.expand_dims(tf.convert_to_tensor([[0.5 + 2.j, 1. + 4.j, 2. + 8.j, 2.5 + 4.5j],
-                                                    [2. + 2.j, 4. + 4.j, 8. + 2.j, 4.5 + 6.j]], dtype=tf.complex64),
-                              axis=-1)
-    assert np.all(res.numpy() == expected.numpy())
+    res = avg_pool(img)
+    assert _tensors_equal(res, _EXPECTED_AVG_POOL_1D)
 
 
 @tf.autograph.experimental.do_not_convert
@@ -194,33 +364,14 @@ def complex_max_pool_2d(test_unpool=True):
     img = get_img()
     max_pool = ComplexMaxPooling2DWithArgmax(strides=1, data_format="channels_last")
     max_pool_2 = ComplexMaxPooling2D(strides=1, data_format="channels_last")
-    res, argmax = max_pool(img.astype(np.complex64))
-    res2 = max_pool_2(img.astype(np.complex64))
-    expected_res = np.array([
-        [[
-            [2. + 7.j],
-            [2. + 9.j]],
-            [[2. + 7.j],
-             [2. + 9.j]]],
-        [[
-            [7. + 4.j],
-            [9. + 2.j]],
-            [
-                [5. + 8.j],
-                [3. + 9.j]]]
-    ])
-    assert np.all(res.numpy() == res2.numpy())
-    assert (res.numpy() == expected_res.astype(np.complex64)).all()
+    res, argmax = max_pool(img)
+    res2 = max_pool_2(img)
+    assert _tensors_equal(res, res2)
+    assert _tensors_equal(res, _EXPECTED_MAX_POOL_2D)
     if test_unpool:
         max_unpooling = ComplexUnPooling2D(img.shape[1:])
         unpooled = max_unpooling([res, argmax])
-        expected_unpooled = np.array([[[0. + 0.j, 0. + 0.j, 0. + 0.j],
-                                       [0. + 0.j, 4. + 14.j, 4. + 18.j],
-                                       [0. + 0.j, 0. + 0.j, 0. + 0.j]],
-                                      [[0. + 0.j, 7. + 4.j, 0. + 0.j],
-                                       [0. + 0.j, 0. + 0.j, 9. + 2.j],
-                                       [0. + 0.j, 5. + 8.j, 3. + 9.j]]]).reshape(2, 3, 3, 1)
-        assert np.all(unpooled.numpy() == expected_unpooled)
+        assert _tensors_equal(unpooled, _EXPECTED_MAX_UNPOOL_2D)
 
     x = tf.constant([[1., 2., 3.],
                      [4., 5., 6.],
@@ -228,26 +379,65 @@ def complex_max_pool_2d(test_unpool=True):
     x = tf.reshape(x, [1, 3, 3, 1])
     max_pool_2d = tf.keras.layers.MaxPooling2D(pool_size=(2, 2), strides=(1, 1), padding='valid')
     complex_max_pool_2d = ComplexMaxPooling2D(pool_size=(2, 2), strides=(1, 1), padding='valid')
-    assert np.all(max_pool_2d(x) == complex_max_pool_2d(x))
+    assert _tensors_equal(max_pool_2d(x), complex_max_pool_2d(x))
+
+
+@tf.autograph.experimental.do_not_convert
+def complex_unpooling_2d_upsampling_factor():
+    x = tf.reshape(tf.range(32, dtype=tf.float32), (2, 4, 4, 1))
+    img = tf.complex(x, tf.reverse(x, axis=[1]))
+    max_pool = ComplexMaxPooling2DWithArgmax(pool_size=2, data_format="channels_last")
+    res, argmax = max_pool(img)
+    unpooled = ComplexUnPooling2D(upsampling_factor=2)([res, argmax])
+    assert unpooled.shape == (2, 4, 4, 1)
+    assert _tensors_equal(unpooled, ComplexUnPooling2D(img.shape[1:])([res, argmax]))
 
 
 def new_max_unpooling_2d_test():
-    img = get_img()
-    new_imag = tf.stack((img.reshape((2, 3, 3)), img.reshape((2, 3, 3))), axis=-1)
+    img = tf.reshape(tf.constant(get_img(), dtype=tf.complex64), (2, 3, 3))
+    new_imag = tf.stack((img, img), axis=-1)
     max_pool = ComplexMaxPooling2DWithArgmax(strides=1, data_format="channels_last")
-    res, argmax = max_pool(tf.cast(new_imag, dtype=np.complex64))
+    res, argmax = max_pool(new_imag)
     max_unpooling = ComplexUnPooling2D(new_imag.shape[1:])
     unpooled = max_unpooling([res, argmax])
 
 
+@tf.autograph.experimental.do_not_convert
+def complex_pooling_2d_channels_first():
+    x = tf.complex(tf.random.stateless_normal((2, 4, 6, 3), seed=(2, 3)),
+                   tf.random.stateless_normal((2, 4, 6, 3), seed=(4, 5)))
+    x_first = tf.transpose(x, perm=(0, 3, 1, 2))
+    to_last = functools.partial(tf.transpose, perm=(0, 2, 3, 1))
+    res, argmax = ComplexMaxPooling2DWithArgmax(data_format="channels_last")(x)
+    res_first, argmax_first = ComplexMaxPooling2DWithArgmax(data_format="channels_first")(x_first)
+    assert _tensors_equal(to_last(res_first), res)
+    # argmax indexes the flattened channels_first input
+    assert _tensors_equal(tf.gather(tf.reshape(x_first, [-1]), argmax_first), res_first)
+    max_pool_first = ComplexMaxPooling2D(data_format="channels_first")
+    assert _tensors_equal(to_last(max_pool_first(x_first)), res)
+    assert _tensors_equal(max_pool_first.get_max_index(), argmax_first)
+    unpooled = ComplexUnPooling2D(x.shape[1:])([res, argmax])
+    unpooled_first = ComplexUnPooling2D(x_first.shape[1:])([res_first, argmax_first])
+    assert _tensors_equal(to_last(unpooled_first), unpooled)
+    avg = ComplexAvgPooling2D(data_format="channels_last")(x)
+    avg_first = ComplexAvgPooling2D(data_format="channels_first")(x_first)
+    assert _tensors_equal(to_last(avg_first), avg)
+
+
+def complex_pooling_3d_output_shape():
+    for data_format, input_shape in (("channels_last", (None, 8, 9, 7, 2)), ("channels_first", (None, 2, 8, 9, 7))):
+        for padding in ('valid', 'same'):
+            kwargs = dict(pool_size=(2, 3, 1), strides=(1, 2, 3), padding=padding, data_format=data_format)
+            expected = tf.keras.layers.AveragePooling3D(**kwargs).compute_output_shape(input_shape)
+            assert ComplexAvgPooling3D(**kwargs).compute_output_shape(input_shape) == expected
+
+
 @tf.autograph.experimental.do_not_convert
 def complex_avg_pool():
     img = get_img()
     avg_pool = ComplexAvgPooling2D(strides=1)
-    res = avg_pool(img.astype(np.complex64))
-    expected_res = np.array([[[[0.75 + 3.5j], [1.75 + 6.25j]], [[1.75 + 4.75j], [4. + 6.j]]],
-                             [[[4.25 + 2.25j], [7 + 3.25j]], [[4.75 + 4.25j], [6. + 5.25j]]]])
-    assert (res.numpy() == expected_res.astype(np.complex64)).all()
+    res = avg_pool(img)
+    assert _tensors_equal(res, _EXPECTED_AVG_POOL_2D)
 
 
 @tf.autograph.experimental.do_not_convert
@@ -262,7 +452,9 @@ def complex_conv_2d_transpose():
         [169., 264., 326., 204.],
         [57., 107., 164., 100.]
     ], dtype=np.float32)
-    assert np.allclose(transpose_2(input).numpy().reshape((4, 4)), expected)  # TODO: Check why the difference
+    transpose_2.build(input.shape)
+    assert np.allclose(tf.function(transpose_2, jit_compile=True)(input).numpy().reshape((4, 4)),
+                       expected)  # TODO: Check why the difference
     value = [[1, 2], [2, 1]]
     init = tf.constant_initializer(value)
     transpose_3 = ComplexConv2DTranspose(1, kernel_size=2, kernel_initializer=init, dtype=np.float32)
@@ -273,8 +465,10 @@ def complex_conv_2d_transpose():
     ], dtype=np.float32)
     assert np.allclose(transpose_3(input).numpy().reshape((3, 3)), expected)
     complex_transpose = ComplexConv2DTranspose(1, kernel_size=2, dtype=np.complex64)
-    complex_input = (input + 1j * np.zeros(input.shape)).astype(np.complex64)
+    complex_input = _make_complex(input, np.zeros(input.shape))
     assert complex_transpose(complex_input).dtype == tf.complex64
+    z = tf.complex(tf.random.stateless_normal((2, 3, 3, 2), seed=(0, 4)), tf.random.stateless_normal((2, 3, 3, 2), seed=(0, 5)))
+    _check_complex_bias(ComplexConv2DTranspose(3, kernel_size=2, strides=2), z, channel_axis=-1)
 
 
 @tf.autograph.experimental.do_not_convert
@@ -284,65 +478,28 @@ def upsampling_near_neighbour():
     z = tf.complex(real=x, imag=x)
     upsample = ComplexUpSampling2D(size=(2, 3))
     y = upsample(z)
-    expected = np.array([[[[0. + 0.j, 1. + 1.j, 2. + 2.j],
-                           [0. + 0.j, 1. + 1.j, 2. + 2.j],
-                           [0. + 0.j, 1. + 1.j, 2. + 2.j]],
-                          [[0. + 0.j, 1. + 1.j, 2. + 2.j],
-                           [0. + 0.j, 1. + 1.j, 2. + 2.j],
-                           [0. + 0.j, 1. + 1.j, 2. + 2.j]],
-                          [[3. + 3.j, 4. + 4.j, 5. + 5.j],
-                           [3. + 3.j, 4. + 4.j, 5. + 5.j],
-                           [3. + 3.j, 4. + 4.j, 5. + 5.j]],
-                          [[3. + 3.j, 4. + 4.j, 5. + 5.j],
-                           [3. + 3.j, 4. + 4.j, 5. + 5.j],
-                           [3. + 3.j, 4. + 4.j, 5. + 5.j]]],
-                         [[[6. + 6.j, 7. + 7.j, 8. + 8.j],
-                           [6. + 6.j, 7. + 7.j, 8. + 8.j],
-                           [6. + 6.j, 7. + 7.j, 8. + 8.j]],
-                          [[6. + 6.j, 7. + 7.j, 8. + 8.j],
-                           [6. + 6.j, 7. + 7.j, 8. + 8.j],
-                           [6. + 6.j, 7. + 7.j, 8. + 8.j]],
-                          [[9. + 9.j, 10. + 10.j, 11. + 11.j],
-                           [9. + 9.j, 10. + 10.j, 11. + 11.j],
-                           [9. + 9.j, 10. + 10.j, 11. + 11.j]],
-                          [[9. + 9.j, 10. + 10.j, 11. + 11.j],
-                           [9. + 9.j, 10. + 10.j, 11. + 11.j],
-                           [9. + 9.j, 10. + 10.j, 11. + 11.j]]]])
-    assert np.all(y.numpy() == expected)
+    assert _tensors_equal(y, _EXPECTED_NEAREST_UPSAMPLING_2_3)
     upsample = ComplexUpSampling2D(size=(1, 3))
     y = upsample(z)
-    expected = np.array([[[[0. + 0.j, 1. + 1.j, 2. + 2.j],
-                           [0. + 0.j, 1. + 1.j, 2. + 2.j],
-                           [0. + 0.j, 1. + 1.j, 2. + 2.j]],
-                          [[3. + 3.j, 4. + 4.j, 5. + 5.j],
-                           [3. + 3.j, 4. + 4.j, 5. + 5.j],
-                           [3. + 3.j, 4. + 4.j, 5. + 5.j]]],
-                         [[[6. + 6.j, 7. + 7.j, 8. + 8.j],
-                           [6. + 6.j, 7. + 7.j, 8. + 8.j],
-                           [6. + 6.j, 7. + 7.j, 8. + 8.j]],
-                          [[9. + 9.j, 10. + 10.j, 11. + 11.j],
-                           [9. + 9.j, 10. + 10.j, 11. + 11.j],
-                           [9. + 9.j, 10. + 10.j, 11. + 11.j]]]])
-    assert np.all(y.numpy() == expected)
+    assert _tensors_equal(y, _EXPECTED_NEAREST_UPSAMPLING_1_3)
     upsample = ComplexUpSampling2D(size=(1, 2))
     y = upsample(z)
     # print(y)
     y_tf = tf.keras.layers.UpSampling2D(size=(1, 2))(x)
     my_y = upsample.get_real_equivalent()(x)
-    assert np.all(my_y == y_tf)
-    x = tf.convert_to_tensor([[[[1., 2.], [3., 4.]]]])
+    assert _tensors_equal(my_y, y_tf)
+    x = _X_2x2
     upsample = ComplexUpSampling2D(size=2, data_format='channels_first')
     my_y = upsample(x)
     y_tf = tf.keras.layers.UpSampling2D(size=(2, 2), data_format='channels_first')(x)
-    assert np.all(my_y == y_tf)
+    assert _tensors_equal(my_y, y_tf)
 
 
 @tf.autograph.experimental.do_not_convert
 def upsampling_bilinear_corners_aligned():
     # Pytorch examples
     # https://pytorch.org/docs/stable/generated/torch.nn.Upsample.html
-    x = tf.convert_to_tensor([[[[1., 2.], [3., 4.]]]])
-    z = tf.complex(real=x, imag=x)
+    x, z = _X_2x2, _Z_2x2
     expected = np.array([[[[1.0000, 1.3333, 1.6667, 2.0000],
                            [1.6667, 2.0000, 2.3333, 2.6667],
                            [2.3333, 2.6667, 3.0000, 3.3333],
@@ -350,9 +507,7 @@ def upsampling_bilinear_corners_aligned():
     upsample = ComplexUpSampling2D(size=2, interpolation='bilinear', data_format='channels_first', align_corners=True)
     y_complex = upsample(z)
     assert np.allclose(expected, tf.math.real(y_complex).numpy(), 0.0001)
-    x = tf.convert_to_tensor([[[[1., 2., 0.],
-                                [3., 4., 0.],
-                                [0., 0., 0.]]]])
+    x = _X_3x3_PADDED
     expected = np.array([[[[1.0000, 1.4000, 1.8000, 1.6000, 0.8000, 0.0000],
                            [1.8000, 2.2000, 2.6000, 2.2400, 1.1200, 0.0000],
                            [2.6000, 3.0000, 3.4000, 2.8800, 1.4400, 0.0000],
@@ -393,54 +548,59 @@ def upsampling_bilinear_corners_aligned():
 def upsampling_bilinear_corner_not_aligned():
     # Pytorch
     #   https://pytorch.org/docs/stable/generated/torch.nn.Upsample.html
-    x = tf.convert_to_tensor([[[[1., 2.], [3., 4.]]]])
-    z = tf.complex(real=x, imag=x)
+    x, z = _X_2x2, _Z_2x2
     y_tf = tf.keras.layers.UpSampling2D(size=2, interpolation='bilinear', data_format='channels_first')(x)
     y_own = ComplexUpSampling2D(size=2, interpolation='bilinear', data_format='channels_first')(z)
     # set_trace()
-    assert np.all(y_tf == tf.math.real(y_own).numpy())
-    x = tf.convert_to_tensor([[[[1., 2., 0.],
-                                [3., 4., 0.],
-                                [0., 0., 0.]]]])
-    z = tf.complex(real=x, imag=x)
+    assert _tensors_equal(y_tf, tf.math.real(y_own))
+    x, z = _X_3x3_PADDED, _Z_3x3_PADDED
     y_tf = tf.keras.layers.UpSampling2D(size=2, interpolation='bilinear', data_format='channels_first')(x)
     y_own = ComplexUpSampling2D(size=2, interpolation='bilinear', data_format='channels_first')(z)
-    assert np.all(y_tf == tf.math.real(y_own).numpy())
-    x = tf.convert_to_tensor([[[[1., 2.], [3., 4.]]]])
-    z = tf.complex(real=x, imag=x)
-    y_tf = tf.keras.layers.UpSampling2D(size=3, interpolation='bilinear', data_format='channels_first')(x)
-    y_own = ComplexUpSampling2D(size=3, interpolation='bilinear', data_format='channels_first')(z)
-    assert np.allclose(y_tf, tf.math.real(y_own).numpy())
-    y_tf = tf.keras.layers.UpSampling2D(size=6, interpolation='bilinear', data_format='channels_first')(x)
-    y_own = ComplexUpSampling2D(size=6, interpolation='bilinear', data_format='channels_first')(z)
-    assert np.allclose(y_tf, tf.math.real(y_own).numpy())
-    y_tf = tf.keras.layers.UpSampling2D(size=8, interpolation='bilinear', data_format='channels_first')(x)
-    y_own = ComplexUpSampling2D(size=8, interpolation='bilinear', data_format='channels_first')(z)
-    assert np.all(y_tf == tf.math.real(y_own).numpy())
+    assert _tensors_equal(y_tf, tf.math.real(y_own))
+    x, z = _X_2x2, _Z_2x2
+
+    @tf.function(jit_compile=True)
+    def _all_upsamples(x, z):
+        # Upsampling layers have no weights so they can be created inside the compiled function.
+        return [(tf.keras.layers.UpSampling2D(size=size, interpolation='bilinear', data_format='channels_first')(x),
+                 ComplexUpSampling2D(size=size, interpolation='bilinear', data_format='channels_first')(z))
+                for size in (3, 6, 8)]
+
+    (y_tf_3, y_own_3), (y_tf_6, y_own_6), (y_tf_8, y_own_8) = _all_upsamples(x, z)
+    assert np.allclose(y_tf_3, tf.math.real(y_own_3).numpy())
+    assert np.allclose(y_tf_6, tf.math.real(y_own_6).numpy())
+    assert _tensors_equal(y_tf_8, tf.math.real(y_own_8))
     # to test bicubic= https://discuss.pytorch.org/t/what-we-should-use-align-corners-false/22663/17
     # https://www.tensorflow.org/api_docs/python/tf/keras/layers/UpSampling2D
     input_shape = (2, 2, 1, 3)
     x = np.arange(np.prod(input_shape)).reshape(input_shape)
     y_tf = tf.keras.layers.UpSampling2D(size=(1, 2), interpolation='bilinear')(x)
     y_own = ComplexUpSampling2D(size=(1, 2), interpolation='bilinear')(x)
-    assert np.all(y_tf == y_own)
+    assert _tensors_equal(y_tf, y_own)
 
 
 @tf.autograph.experimental.do_not_convert
 def upsampling():
-    x = tf.convert_to_tensor([[[[1., 2.], [3., 4.]]]])
-    z = tf.complex(real=x, imag=x)
+    x, z = _X_2x2, _Z_2x2
     y_tf = tf.keras.layers.UpSampling2D(size=2, interpolation='bilinear', data_format='channels_first')(x)
     y_cvnn = ComplexUpSampling2D(size=2, interpolation='bilinear', data_format='channels_first')(z)
-    assert np.all(y_tf == tf.math.real(y_cvnn).numpy())
+    assert _tensors_equal(y_tf, tf.math.real(y_cvnn))
     upsampling_near_neighbour()
     # test_upsampling_bilinear_corners_aligned()
     upsampling_bilinear_corner_not_aligned()
 
 
+def batched_dense():
+    layer = ComplexDense(units=4)
+    x = tf.complex(np.random.rand(8, 3).astype(np.float32), np.random.rand(8, 3).astype(np.float32))
+    y = batched_call(layer, x)
+    assert y.shape == (8, 4)
+    assert np.allclose(y, layer(x), atol=1e-6)
+
+
 def check_proximity(x1, x2, name: str):
     th = 0.1
-    diff = np.max(np.abs(x1 - x2))
+    diff = float(tf.reduce_max(tf.abs(tf.convert_to_tensor(x1) - x2)))     # Modulus if complex
     if 0 < diff < th:
         print(f"{name} are equal with an error of {diff}")
     if diff >= th:
@@ -455,12 +615,12 @@ def batch_norm():
     # # set_trace()
     # assert check_proximity(c_out, z, "Normalized input")
 
-    z = np.random.rand(3, 43, 12, 10)  # + np.random.rand(3, 43, 12, 75)*1j
+    # Generated directly on the device, stateless so every run uses the same input.
+    input = tf.random.stateless_uniform((3, 43, 12, 10), seed=(0, 1), dtype=tf.float32)
     # z = np.random.rand(100, 10)
     bn = tf.keras.layers.BatchNormalization(epsilon=0)
     c_bn = ComplexBatchNormalization(dtype=np.float32)  # If I use the complex64 then the init is different
     c_bn_2 = ComplexBatchNormalization(dtype=np.float32, cov_method=2)
-    input = tf.convert_to_tensor(z.astype(np.float32), dtype=np.float32)
     out = bn(input, training=False)
     c_out = c_bn(input, training=False)
     assert check_proximity(out, c_out, "Results before training")
@@ -483,22 +643,43 @@ def batch_norm():
     assert check_proximity(c_bn_2.beta, c_bn.beta, "Method comparison Beta after training")
 
 
+def complex_batch_norm():
+    x_r = tf.random.stateless_normal((64, 10), seed=(5, 6))
+    x_i = 0.5 * x_r + tf.random.stateless_normal((64, 10), seed=(7, 8))    # Correlated, so Cri != 0
+    # Covariance matrices [[Crr, Cri], [Cri, Cii]] of each complex feature
+    x = tf.stack((x_r, x_i), axis=-1)
+    centered = x - tf.math.reduce_mean(x, axis=0)
+    var = tf.einsum("nfi,nfj->fij", centered, centered) / x.shape[0]
+    expected = tf.linalg.sqrtm(tf.linalg.inv(var))
+    assert np.allclose(ComplexBatchNormalization._inverse_sqrt_2x2(var), expected, atol=1e-5)
+    z = tf.complex(x_r, x_i)
+    c_bn = ComplexBatchNormalization()
+    c_bn_2 = ComplexBatchNormalization(cov_method=2)
+    assert check_proximity(c_bn(z, training=True), c_bn_2(z, training=True), "Complex method comparison results")
+    assert check_proximity(c_bn.moving_var, c_bn_2.moving_var, "Complex method comparison moving variance")
+
+
 def pooling_layers():
     complex_max_pool_2d()
     complex_avg_pool_1d()
     complex_avg_pool()
+    complex_pooling_2d_channels_first()
+    complex_pooling_3d_output_shape()
 
 
-@tf.autograph.experimental.do_not_convert
-def test_layers():
-    new_max_unpooling_2d_test()
-    pooling_layers()
-    batch_norm()
-    upsampling()
-    complex_conv_2d_transpose()
-    shape_ad_dtype_of_conv2d()
-    dense_example()
+_LAYER_SUBTESTS = [
+    new_max_unpooling_2d_test, complex_unpooling_2d_upsampling_factor, pooling_layers, batch_norm,
+    complex_batch_norm, upsampling, complex_conv_2d_transpose, shape_ad_dtype_of_conv2d, complex_conv_2d_value,
+    complex_conv_1d_causal, dense_example, flatten_reuse, dense_serialization, batched_dense,
+    dropout_rate, dropout_noise_shape, complex_conv_bias
+]
+
+
+@pytest.mark.parametrize("subtest", _LAYER_SUBTESTS, ids=lambda f: f.__name__)
+def test_layers(subtest):
+    subtest()
 
 
 if __name__ == "__main__":
-    test_layers()
+    for subtest in _LAYER_SUBTESTS:
+        subtest()